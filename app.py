@@ -3,15 +3,41 @@
 Streamlit app for Mistral OCR - PDF to Markdown/DOCX converter
 """
 import streamlit as st
+import concurrent.futures
+import gc
+import hashlib
+import io
 import tempfile
 import json
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import base64
-import requests
 
-# Import OCR functions from mistral_ocr
-import mistral_ocr
+# mistral_ocr (which drags in PIL, PyMuPDF and python-docx) and requests are
+# imported lazily inside the functions that need them: Streamlit re-executes
+# this module on every interaction, and the common "app open, nothing
+# uploaded yet" path shouldn't pay for them at first paint.
+
+# Optional orjson (2-5x faster parse/serialize for the multi-MB OCR JSON)
+HAVE_ORJSON = True
+try:
+    import orjson
+except Exception:
+    HAVE_ORJSON = False
+
+# Optional ijson (incremental parse straight off the response socket)
+HAVE_IJSON = True
+try:
+    import ijson
+except Exception:
+    HAVE_IJSON = False
+
+# Disk cache for OCR responses (OCR is deterministic per PDF + model)
+OCR_CACHE_DIR = Path(tempfile.gettempdir()) / "mistral_ocr_cache"
+
+# Cap on the markdown preview sent to the browser per rerun; the download
+# button always serves the full text
+MD_PREVIEW_LIMIT = 100_000
 
 # Configure Streamlit page
 st.set_page_config(
@@ -21,14 +47,12 @@ st.set_page_config(
 )
 
 # Initialize session state
-if 'ocr_result' not in st.session_state:
-    st.session_state.ocr_result = None
-if 'pages_text' not in st.session_state:
-    st.session_state.pages_text = []
-if 'md_text' not in st.session_state:
-    st.session_state.md_text = None
-if 'docx_path' not in st.session_state:
-    st.session_state.docx_path = None
+if 'results_by_file' not in st.session_state:
+    st.session_state.results_by_file = {}
+if 'last_filenames' not in st.session_state:
+    st.session_state.last_filenames = None
+if 'last_pdf_key' not in st.session_state:
+    st.session_state.last_pdf_key = None
 
 def get_config_from_secrets():
     """Load configuration from Streamlit secrets"""
@@ -43,35 +67,140 @@ def get_config_from_secrets():
         st.info("Please configure your secrets.toml file. See README.md for details.")
         return None
 
-def post_ocr_with_config(payload: dict, config: dict):
-    """Post OCR request using configuration from secrets"""
-    headers = {
-        "Authorization": f"Bearer {config['api_key']}",
+# Base64-encode the PDF in 48 KB slices (multiple of 3, so chunks concatenate
+# into valid base64 without padding in the middle)
+_B64_CHUNK = 48 * 1024
+
+def iter_ocr_payload(pdf_bytes: bytes, model: str):
+    """Yield the OCR JSON payload in chunks, base64-encoding the PDF lazily.
+
+    Avoids materializing the full data URL (~1.33x the PDF size) plus a
+    second copy inside the JSON buffer; peak overhead stays at one chunk.
+    """
+    yield (
+        f'{{"model": {json.dumps(model)}, "include_image_base64": false, '
+        f'"document": {{"type": "document_url", '
+        f'"document_url": "data:application/pdf;base64,'
+    ).encode("utf-8")
+    view = memoryview(pdf_bytes)
+    for off in range(0, len(view), _B64_CHUNK):
+        yield base64.b64encode(view[off:off + _B64_CHUNK])
+    yield b'"}}'
+
+class OCRPayload:
+    """Re-iterable wrapper around iter_ocr_payload.
+
+    urllib3 re-sends the body when the session's Retry kicks in on a
+    429/5xx; a bare generator would already be exhausted by then and the
+    retry would deliver an empty chunked body. Each iteration here starts
+    a fresh generator instead.
+    """
+
+    def __init__(self, pdf_bytes: bytes, model: str):
+        self._pdf_bytes = pdf_bytes
+        self._model = model
+
+    def __iter__(self):
+        return iter_ocr_payload(self._pdf_bytes, self._model)
+
+@st.cache_resource(show_spinner=False)
+def get_session(api_key: str):
+    """Shared HTTP session with keep-alive, connection pooling and retries"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+    session.headers.update({
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
-    }
-    r = requests.post(config['endpoint'], headers=headers, json=payload, timeout=600)
-    if r.status_code >= 400:
-        st.error(f"API Error {r.status_code}: {r.text[:500]}")
-        r.raise_for_status()
-    return r.json()
+    })
+    return session
+
+def post_ocr_with_config(pdf_bytes: bytes, config: dict):
+    """Post OCR request for a PDF, streaming the payload in chunks"""
+    import requests
+
+    session = get_session(config['api_key'])
+    body = OCRPayload(pdf_bytes, config['model'])
+    r = session.post(config['endpoint'], data=body, timeout=600, stream=True)
+    try:
+        if r.status_code >= 400:
+            # Raise instead of calling st.error so this is safe to run from
+            # worker threads; the UI layer reports failures per file
+            raise requests.HTTPError(f"API Error {r.status_code}: {r.text[:500]}", response=r)
+        if HAVE_IJSON:
+            # Parse incrementally off the socket: pages are built one at a
+            # time instead of buffering the whole multi-MB body and then
+            # parsing a second full-size copy. The raw-response tab and the
+            # disk cache still need the complete dict, so the result is the
+            # same tree - only the transient copies go away.
+            # use_float: ijson yields Decimal for JSON floats by default,
+            # which neither orjson nor stdlib json can serialize later
+            r.raw.decode_content = True
+            return dict(ijson.kvitems(r.raw, "", use_float=True))
+        if HAVE_ORJSON:
+            return orjson.loads(r.content)  # parses bytes directly, no text decode
+        return r.json()
+    finally:
+        r.close()
+
+@st.cache_data(show_spinner=False)
+def run_ocr_cached(cache_key: str, _pdf_bytes: bytes, _config: dict):
+    """Run OCR with a disk cache keyed on PDF content + model.
+
+    Cache hits skip the network round-trip and model inference entirely;
+    the st.cache_data layer additionally memoizes hits within the session.
+    """
+    cache_file = OCR_CACHE_DIR / f"{cache_key}.json"
+    if cache_file.exists():
+        try:
+            raw = cache_file.read_bytes()
+            return orjson.loads(raw) if HAVE_ORJSON else json.loads(raw)
+        except Exception:
+            pass  # corrupt cache entry - fall through and re-run OCR
+    resp = post_ocr_with_config(_pdf_bytes, _config)
+    try:
+        OCR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        if HAVE_ORJSON:
+            cache_file.write_bytes(orjson.dumps(resp))
+        else:
+            cache_file.write_text(json.dumps(resp, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        pass  # cache write is best-effort; never fail a successful OCR run
+    return resp
 
-def process_pdf(pdf_bytes: bytes, config: dict, title: Optional[str] = None, 
+def process_pdf(pdf_bytes: bytes, config: dict, title: Optional[str] = None,
                 insert_page_breaks: bool = True) -> Dict[str, Any]:
-    """Process PDF through OCR and return results"""
-    
-    # Convert PDF to data URL
-    data_url = mistral_ocr.bytes_to_data_url("application/pdf", pdf_bytes)
-    
-    # Prepare payload
-    payload = {
-        "model": config['model'],
-        "document": {"type": "document_url", "document_url": data_url},
-        "include_image_base64": False,  # Text-only mode
-    }
-    
-    # Call OCR API
-    with st.spinner("Processing PDF with  Doc Intelligence..."):
-        resp = post_ocr_with_config(payload, config)
+    """Process PDF through OCR and return results.
+
+    Makes no st.* UI calls, so it can run in worker threads (see
+    process_pdfs_batch); callers own spinners and error display.
+    """
+    import mistral_ocr
+
+    # Cache key over the PDF content + model (model change invalidates);
+    # keyed on the original bytes so hits don't depend on pikepdf being
+    # installed
+    cache_key = hashlib.blake2b(pdf_bytes + config['model'].encode("utf-8"),
+                                digest_size=16).hexdigest()
+
+    # Shrink the upload when it pays off (no-op for small PDFs or if
+    # pikepdf is unavailable)
+    pdf_bytes = mistral_ocr.maybe_compress_pdf(pdf_bytes)
+
+    # Call OCR API (or reuse a cached response for this exact PDF + model);
+    # the PDF is base64-encoded lazily inside the request body, never as a
+    # full in-memory data URL
+    resp = run_ocr_cached(cache_key, pdf_bytes, config)
+    del pdf_bytes  # drop this frame's reference before the string-heavy phase
     
     # Unwrap response container
     container = mistral_ocr.unwrap_container(resp)
@@ -88,13 +217,14 @@ def process_pdf(pdf_bytes: bytes, config: dict, title: Optional[str] = None,
             raise ValueError("No pages and no usable top-level text found in OCR response.")
         pages = [{"markdown": top}]
     
-    # Extract text from pages
-    pages_text: List[str] = []
-    for i, p in enumerate(pages, start=1):
-        txt = mistral_ocr.extract_from_page(p if isinstance(p, dict) else {}) or ""
-        if title and i == 1:
-            txt = f"# {title}\n\n{txt}"
-        pages_text.append(txt)
+    # Extract text from pages (independent per page, so map in parallel)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(pages))) as ex:
+        pages_text: List[str] = list(ex.map(
+            lambda p: mistral_ocr.extract_from_page(p if isinstance(p, dict) else {}) or "",
+            pages
+        ))
+    if title:
+        pages_text[0] = f"# {title}\n\n{pages_text[0]}"
     
     # Build markdown
     md_text = mistral_ocr.build_markdown(
@@ -109,30 +239,63 @@ def process_pdf(pdf_bytes: bytes, config: dict, title: Optional[str] = None,
         'response': resp,
         'pages_text': pages_text,
         'md_text': md_text,
+        'md_bytes': md_text.encode("utf-8"),  # encoded once for downloads
         'num_pages': len(pages)
     }
 
-def create_docx(md_text: str, pages_text: List[str], output_dir: Path, 
-                insert_page_breaks: bool) -> Path:
-    """Create DOCX file from markdown"""
-    docx_path = output_dir / "output.docx"
-    
-    with st.spinner("Generating DOCX file..."):
-        mistral_ocr.build_hybrid_docx(
-            md_text,
-            pages_text,
-            images_by_page={},
-            crops_by_page={},
-            out_path=docx_path,
-            insert_page_breaks=insert_page_breaks,
-            image_max_width_in=6.5,
-        )
-    
-    return docx_path
+def process_pdfs_batch(files: List[tuple], config: dict, title: Optional[str],
+                       insert_page_breaks: bool) -> Tuple[Dict[str, Dict[str, Any]],
+                                                          Dict[str, str]]:
+    """OCR several PDFs concurrently over the shared keep-alive session.
+
+    `files` is a list of (name, pdf_bytes) pairs. Returns (results, errors),
+    both keyed by file name; a failure on one file does not abort the rest.
+    Concurrency is capped at 4 workers so we stay under the API rate limit
+    while urllib3 multiplexes the pooled connections.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(files))) as ex:
+        futures = {
+            ex.submit(process_pdf, data, config,
+                      title=title, insert_page_breaks=insert_page_breaks): name
+            for name, data in files
+        }
+        for fut in concurrent.futures.as_completed(futures):
+            name = futures[fut]
+            try:
+                results[name] = fut.result()
+            except Exception as e:
+                errors[name] = str(e)
+    # Restore upload order (as_completed yields in finish order)
+    results = {name: results[name] for name, _ in files if name in results}
+    return results, errors
+
+@st.cache_data(show_spinner="Generating DOCX file...")
+def create_docx(md_text: str, pages_text: tuple, insert_page_breaks: bool) -> bytes:
+    """Create DOCX bytes from markdown.
+
+    The DOCX is a pure function of its inputs, so st.cache_data skips the
+    rebuild on reruns where nothing changed (pages_text is passed as a
+    tuple to keep it hashable).
+    """
+    import mistral_ocr
+
+    buf = io.BytesIO()
+    mistral_ocr.build_hybrid_docx(
+        md_text,
+        list(pages_text),
+        images_by_page={},
+        crops_by_page={},
+        out_path=buf,
+        insert_page_breaks=insert_page_breaks,
+        image_max_width_in=6.5,
+    )
+    return buf.getvalue()
 
 def main():
     st.title("📄 Suvichaar Doc Intelligence Platform Test")
-    st.markdown("Upload a PDF file to extract text and convert it to Markdown and DOCX formats.")
+    st.markdown("Upload PDF files to extract text and convert them to Markdown and DOCX formats.")
     
     # Load configuration
     config = get_config_from_secrets()
@@ -149,114 +312,168 @@ def main():
         st.info("💡 Configure your API credentials in `.streamlit/secrets.toml`")
     
     # File upload
-    uploaded_file = st.file_uploader(
-        "Upload PDF File",
+    uploaded_files = st.file_uploader(
+        "Upload PDF Files",
         type=['pdf'],
-        help="Select a PDF file to process"
+        accept_multiple_files=True,
+        help="Select one or more PDF files to process"
     )
-    
-    if uploaded_file is not None:
-        # Display file info
-        file_size = len(uploaded_file.getvalue())
-        st.info(f"📎 File: {uploaded_file.name} ({file_size:,} bytes)")
-        
+
+    if uploaded_files:
+        # New upload set = episode boundary: drop the segment render cache
+        # and the processed-PDF gate
+        filenames = tuple(f.name for f in uploaded_files)
+        if filenames != st.session_state.last_filenames:
+            import mistral_ocr
+            mistral_ocr.reset_segment_cache()
+            st.session_state.last_filenames = filenames
+            st.session_state.last_pdf_key = None
+
+        # Display file info (read each upload once; every getvalue() call
+        # materializes a fresh bytes copy of the whole file)
+        files = [(f.name, f.getvalue()) for f in uploaded_files]
+        total_size = sum(len(data) for _, data in files)
+        st.info(f"📎 {len(files)} file(s) selected ({total_size:,} bytes total)")
+
         # Process button
-        if st.button("🚀 Process PDF", type="primary", use_container_width=True):
+        if st.button(f"🚀 Process {len(files)} PDF(s)", type="primary", use_container_width=True):
             try:
-                pdf_bytes = uploaded_file.getvalue()
-                
-                # Process PDF
-                result = process_pdf(
-                    pdf_bytes,
-                    config,
-                    title=title if title else None,
-                    insert_page_breaks=insert_page_breaks
-                )
-                
-                # Store in session state
-                st.session_state.ocr_result = result['response']
-                st.session_state.pages_text = result['pages_text']
-                st.session_state.md_text = result['md_text']
-                
-                st.success(f"✅ Successfully processed {result['num_pages']} page(s)!")
-                
+                # Gate on content + settings: double-clicks and identical
+                # re-uploads short-circuit to the results already in session
+                # state (settings are part of the key so a changed title or
+                # page-break option still reprocesses)
+                pdf_key = hashlib.blake2b(
+                    b"".join(data for _, data in files)
+                    + repr((filenames, title, insert_page_breaks)).encode("utf-8"),
+                    digest_size=16
+                ).digest()
+
+                if st.session_state.last_pdf_key == pdf_key and st.session_state.results_by_file:
+                    st.success("✅ Already processed - showing existing results.")
+                else:
+                    # Process PDFs concurrently over the shared session
+                    with st.spinner("Processing PDFs with  Doc Intelligence..."):
+                        results, errors = process_pdfs_batch(
+                            files,
+                            config,
+                            title=title if title else None,
+                            insert_page_breaks=insert_page_breaks
+                        )
+
+                    for name, err in errors.items():
+                        st.error(f"❌ Error processing {name}: {err}")
+
+                    # Store in session state
+                    st.session_state.results_by_file = results
+                    # Only arm the gate when everything succeeded, so a
+                    # retry re-runs the failed files
+                    st.session_state.last_pdf_key = pdf_key if not errors else None
+
+                    # The PDFs are no longer needed once results are in
+                    # session state; free the buffers before rendering
+                    del files
+                    gc.collect()
+
+                    if results:
+                        total_pages = sum(r['num_pages'] for r in results.values())
+                        st.success(f"✅ Successfully processed {len(results)} file(s), {total_pages} page(s)!")
+
             except Exception as e:
-                st.error(f"❌ Error processing PDF: {str(e)}")
+                st.error(f"❌ Error processing PDFs: {str(e)}")
                 st.exception(e)
-        
+
         # Display results if available
-        if st.session_state.md_text:
+        if st.session_state.results_by_file:
             st.divider()
             st.header("📊 Results")
-            
-            # Create temporary directory for outputs
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmp_path = Path(tmpdir)
-                
-                # Save markdown
-                md_path = tmp_path / "output.md"
-                md_path.write_text(st.session_state.md_text, encoding="utf-8")
+
+            # One document at a time; the selector only shows with 2+ files
+            file_names = list(st.session_state.results_by_file)
+            if len(file_names) > 1:
+                selected_name = st.selectbox("Document", file_names)
+            else:
+                selected_name = file_names[0]
+            current = st.session_state.results_by_file[selected_name]
+            out_stem = Path(selected_name).stem
+
+            # Create DOCX
+            try:
+                docx_bytes = create_docx(
+                    current['md_text'],
+                    tuple(current['pages_text']),
+                    insert_page_breaks
+                )
+
+                # Download buttons
+                col1, col2 = st.columns(2)
                 
-                # Create DOCX
-                try:
-                    docx_path = create_docx(
-                        st.session_state.md_text,
-                        st.session_state.pages_text,
-                        tmp_path,
-                        insert_page_breaks
+                with col1:
+                    st.download_button(
+                        label="📥 Download Markdown",
+                        data=current['md_bytes'],
+                        file_name=f"{out_stem}.md",
+                        mime="text/markdown",
+                        use_container_width=True
                     )
-                    
-                    # Download buttons
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.download_button(
-                            label="📥 Download Markdown",
-                            data=st.session_state.md_text,
-                            file_name="output.md",
-                            mime="text/markdown",
-                            use_container_width=True
-                        )
-                    
-                    with col2:
-                        if docx_path.exists():
-                            docx_bytes = docx_path.read_bytes()
-                            st.download_button(
-                                label="📥 Download DOCX",
-                                data=docx_bytes,
-                                file_name="output.docx",
-                                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                use_container_width=True
-                            )
-                    
-                    # Preview tabs
-                    tab1, tab2, tab3 = st.tabs(["📝 Markdown Preview", "📄 Pages", "🔍 Raw Response"])
-                    
-                    with tab1:
-                        st.markdown("### Markdown Output")
-                        st.code(st.session_state.md_text, language="markdown")
-                    
-                    with tab2:
-                        st.markdown("### Extracted Pages")
-                        for i, page_text in enumerate(st.session_state.pages_text, start=1):
-                            with st.expander(f"Page {i}", expanded=(i == 1)):
-                                st.text(page_text)
-                    
-                    with tab3:
-                        st.markdown("### Raw OCR Response")
-                        st.json(st.session_state.ocr_result)
-                
-                except Exception as e:
-                    st.error(f"❌ Error creating DOCX: {str(e)}")
-                    st.exception(e)
-                    
-                    # Still offer markdown download
+
+                with col2:
                     st.download_button(
-                        label="📥 Download Markdown (DOCX failed)",
-                        data=st.session_state.md_text,
-                        file_name="output.md",
-                        mime="text/markdown"
+                        label="📥 Download DOCX",
+                        data=docx_bytes,
+                        file_name=f"{out_stem}.docx",
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        use_container_width=True
                     )
+                
+                # Preview tabs
+                tab1, tab2, tab3 = st.tabs(["📝 Markdown Preview", "📄 Pages", "🔍 Raw Response"])
+                
+                with tab1:
+                    st.markdown("### Markdown Output")
+                    preview = current['md_text']
+                    if len(preview) > MD_PREVIEW_LIMIT:
+                        preview = (preview[:MD_PREVIEW_LIMIT]
+                                   + "\n\n…[truncated, download full file below]…")
+                        st.caption(f"Preview limited to the first {MD_PREVIEW_LIMIT:,} characters.")
+                    st.code(preview, language="markdown")
+
+                with tab2:
+                    st.markdown("### Extracted Pages")
+                    # One page at a time - rendering every page inside
+                    # expanders ships the whole document over the
+                    # websocket on each rerun
+                    page_num = st.selectbox(
+                        "Page",
+                        range(1, len(current['pages_text']) + 1),
+                        format_func=lambda n: f"Page {n}",
+                    )
+                    st.text(current['pages_text'][page_num - 1])
+
+                with tab3:
+                    st.markdown("### Raw OCR Response")
+                    # st.code instead of st.json: the client-side JSON
+                    # tree widget is very slow on multi-MB responses
+                    if HAVE_ORJSON:
+                        raw_json = orjson.dumps(
+                            current['response'],
+                            option=orjson.OPT_INDENT_2
+                        ).decode("utf-8")
+                    else:
+                        raw_json = json.dumps(current['response'],
+                                              ensure_ascii=False, indent=2)
+                    st.code(raw_json, language="json")
+
+            except Exception as e:
+                st.error(f"❌ Error creating DOCX: {str(e)}")
+                st.exception(e)
+
+                # Still offer markdown download
+                st.download_button(
+                    label="📥 Download Markdown (DOCX failed)",
+                    data=current['md_bytes'],
+                    file_name=f"{out_stem}.md",
+                    mime="text/markdown"
+                )
 
 if __name__ == "__main__":
     main()
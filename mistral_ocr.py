@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import os, sys, json, base64, requests, argparse, re, io, shutil, tempfile
+import os, sys, json, base64, requests, argparse, re, io, shutil, tempfile, functools
 from typing import Dict, Any, List, Tuple, Optional
 from pathlib import Path
 
@@ -29,6 +29,41 @@ def ensure_pandoc_available() -> bool:
             return False
     return False
 
+# ==== Optional pikepdf (recompress PDFs before upload) ========================
+HAVE_PIKEPDF = True
+try:
+    import pikepdf  # type: ignore
+except Exception:
+    HAVE_PIKEPDF = False
+
+_COMPRESS_MIN_BYTES  = 1 << 20  # don't bother below 1 MB
+_COMPRESS_KEEP_RATIO = 0.8      # keep the result only if >=20% smaller
+
+def maybe_compress_pdf(pdf_bytes: bytes) -> bytes:
+    """Recompress a PDF in memory if it shrinks meaningfully.
+
+    Many PDFs are 2-5x larger than necessary (uncompressed streams,
+    duplicate objects); smaller input means proportionally less base64 on
+    the wire. Returns the original bytes for small files, marginal wins,
+    or any pikepdf failure.
+    """
+    if not HAVE_PIKEPDF or len(pdf_bytes) < _COMPRESS_MIN_BYTES:
+        return pdf_bytes
+    try:
+        out = io.BytesIO()
+        with pikepdf.Pdf.open(io.BytesIO(pdf_bytes)) as pdf:
+            pdf.save(out, compress_streams=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                     linearize=True)
+        compressed = out.getvalue()
+    except Exception as e:
+        print(f"[WARN] PDF recompression failed: {e}")
+        return pdf_bytes
+    if len(compressed) < _COMPRESS_KEEP_RATIO * len(pdf_bytes):
+        print(f"[INFO] recompressed PDF {len(pdf_bytes)} -> {len(compressed)} bytes")
+        return compressed
+    return pdf_bytes
+
 # ==== Imaging / PDF / DOCX fallback ==========================================
 from PIL import Image
 import fitz  # PyMuPDF
@@ -251,27 +286,54 @@ def detect_math_or_tables(pages_text: List[str]) -> bool:
 _IMG_MD_RE   = re.compile(r'!\[[^\]]*\]\([^)]+\)', re.IGNORECASE)
 _IMG_HTML_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
 
+# Precompiled patterns for the per-page/per-cell cleanup passes (these run
+# once per chunk on large documents, so avoid re-compiling inside the loops)
+_IMG_MD_MALFORMED_RE = re.compile(r'!\[[^\]]*\]\s*[^\]]*\]\([^)]*\)', re.IGNORECASE)  # e.g. ![img-1.jpeg] peg](img-1 -1.jpeg)
+_IMG_MD_ANY_RE       = re.compile(r'!\[[^\]]*\]\([^)]*\)', re.IGNORECASE)
+_HTML_TAG_RE         = re.compile(r'<[^>]+>')
+_HTML_TAG_NO_MATH_RE = re.compile(r'<(?!/?(?:math|mi|mo|mn|mfrac|msup|msub|mover|munder|mtable|mtr|mtd))[^>]+>')
+_MULTI_BLANK_RE      = re.compile(r'\n{3,}')
+_TABLE_SEP_RE        = re.compile(r'^\|?\s*:?-+:?\s*\|')
+_NUMBERED_ITEM_RE    = re.compile(r'^(\d+)[.)]\s+(.+)')
+
 def strip_inline_images(md: str) -> str:
     return _IMG_HTML_RE.sub('', _IMG_MD_RE.sub('', md))
 
 def clean_markdown_for_docx(md: str) -> str:
     """Clean markdown text for DOCX conversion - remove malformed image links, HTML tags, etc."""
     # Remove all image links (including malformed ones)
-    md = re.sub(r'!\[[^\]]*\]\s*[^\]]*\]\([^)]*\)', '', md, flags=re.IGNORECASE)  # Malformed like ![img-1.jpeg] peg](img-1 -1.jpeg)
-    md = re.sub(r'!\[[^\]]*\]\([^)]*\)', '', md, flags=re.IGNORECASE)  # Normal image links
-    
+    md = _IMG_MD_MALFORMED_RE.sub('', md)  # Malformed like ![img-1.jpeg] peg](img-1 -1.jpeg)
+    md = _IMG_MD_ANY_RE.sub('', md)  # Normal image links
+
     # Convert <br> tags to line breaks
     md = md.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
     md = md.replace('<br>', '\n').replace('</br>', '\n')
-    
+
     # Remove any remaining HTML tags
-    md = re.sub(r'<[^>]+>', '', md)
-    
+    md = _HTML_TAG_RE.sub('', md)
+
     # Clean up multiple blank lines
-    md = re.sub(r'\n{3,}', '\n\n', md)
-    
+    md = _MULTI_BLANK_RE.sub('\n\n', md)
+
     return md.strip()
 
+@functools.lru_cache(maxsize=2048)
+def _clean_segment(seg: str) -> str:
+    """Clean one paragraph segment (memoized).
+
+    Boilerplate repeated across pages and documents (headers, footers,
+    recurring tables) hits the cache instead of re-running the regexes.
+    """
+    return strip_inline_images(seg)
+
+def _clean_page_text(txt: str) -> str:
+    """Split a page into paragraph segments and clean each via the cache."""
+    return "\n\n".join(_clean_segment(seg) for seg in _strip(txt).split("\n\n"))
+
+def reset_segment_cache() -> None:
+    """Drop the segment cache (call at episode boundaries, e.g. a new upload)."""
+    _clean_segment.cache_clear()
+
 def md_image(path: Path, width_in: float) -> str:
     p = Path(path).resolve().as_posix()
     return f'![]({p}){{width={width_in}in}}'
@@ -283,7 +345,7 @@ def build_markdown(pages_text: List[str],
                    image_max_width_in: float) -> str:
     parts: List[str] = []
     for i, txt in enumerate(pages_text, start=1):
-        text_clean = strip_inline_images(_strip(txt))
+        text_clean = _clean_page_text(txt)
         parts.append(f"\n\n## Page {i}\n\n{text_clean}\n")
         for im in images_by_page.get(i, []):
             parts.append("\n" + md_image(im, image_max_width_in) + "\n")
@@ -326,7 +388,7 @@ def parse_markdown_table(table_text: str) -> Tuple[List[List[str]], List[str]]:
     
     for line in lines:
         # Check if it's a separator line (like |:--:|:--:|)
-        if re.match(r'^\|?\s*:?-+:?\s*\|', line):
+        if _TABLE_SEP_RE.match(line):
             separator_line = line
             # Parse alignment from separator
             cells = [cell.strip() for cell in line.split('|')]
@@ -385,7 +447,7 @@ def add_markdown_table(doc: Document, table_text: str):
             
             # Clean cell text (remove <br> tags, etc.)
             cell_text = cell_text.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
-            cell_text = re.sub(r'<[^>]+>', '', cell_text)  # Remove HTML tags
+            cell_text = _HTML_TAG_RE.sub('', cell_text)  # Remove HTML tags
             
             # Set cell text
             cell.text = cell_text.strip()
@@ -449,7 +511,7 @@ def add_text_block(doc: Document, text: str):
             while j < len(chunks):
                 next_chunk = chunks[j].strip()
                 # Check if it's a table line (has |) or separator line
-                if next_chunk and ('|' in next_chunk or re.match(r'^\|?\s*:?-+:?\s*\|', next_chunk)):
+                if next_chunk and ('|' in next_chunk or _TABLE_SEP_RE.match(next_chunk)):
                     table_lines.append(next_chunk)
                     j += 1
                 else:
@@ -473,11 +535,11 @@ def add_text_block(doc: Document, text: str):
             continue
         
         # Check if it's a numbered list
-        numbered_match = re.match(r'^(\d+)[.)]\s+(.+)', chunk)
+        numbered_match = _NUMBERED_ITEM_RE.match(chunk)
         if numbered_match:
             list_items = []
             for line in chunk.split('\n'):
-                match = re.match(r'^(\d+)[.)]\s+(.+)', line.strip())
+                match = _NUMBERED_ITEM_RE.match(line.strip())
                 if match:
                     list_items.append(match.group(2))
             for item in list_items:
@@ -504,19 +566,19 @@ def clean_markdown_for_pandoc(md_text: str) -> str:
     """Clean markdown specifically for Pandoc - remove HTML, fix tables, keep math"""
     md = md_text  # Initialize md with input
     # Remove malformed image links
-    md = re.sub(r'!\[[^\]]*\]\s*[^\]]*\]\([^)]*\)', '', md, flags=re.IGNORECASE)
-    md = re.sub(r'!\[[^\]]*\]\([^)]*\)', '', md, flags=re.IGNORECASE)
-    
+    md = _IMG_MD_MALFORMED_RE.sub('', md)
+    md = _IMG_MD_ANY_RE.sub('', md)
+
     # Convert <br> to actual line breaks (Pandoc handles this better)
     md = md.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
-    
+
     # Remove other HTML tags (but preserve math)
     # Don't remove $...$ or $$...$$ or \(...\) etc.
-    md = re.sub(r'<(?!/?(?:math|mi|mo|mn|mfrac|msup|msub|mover|munder|mtable|mtr|mtd))[^>]+>', '', md)
-    
+    md = _HTML_TAG_NO_MATH_RE.sub('', md)
+
     # Clean up multiple blank lines
-    md = re.sub(r'\n{3,}', '\n\n', md)
-    
+    md = _MULTI_BLANK_RE.sub('\n\n', md)
+
     return md.strip()
 
 def extract_tables_from_markdown(md_text: str) -> List[Tuple[str, int, str]]:
@@ -535,7 +597,7 @@ def extract_tables_from_markdown(md_text: str) -> List[Tuple[str, int, str]]:
             # Collect table lines (including separator)
             while i < len(lines):
                 next_line = lines[i].strip()
-                if next_line and ('|' in next_line or re.match(r'^\|?\s*:?-+:?\s*\|', next_line)):
+                if next_line and ('|' in next_line or _TABLE_SEP_RE.match(next_line)):
                     table_lines.append(next_line)
                     i += 1
                 else:
@@ -575,7 +637,7 @@ def create_formatted_table(doc: Document, md_table_text: str) -> Optional[Any]:
             
             # Clean cell text
             cell_text = cell_text.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
-            cell_text = re.sub(r'<[^>]+>', '', cell_text)  # Remove HTML tags
+            cell_text = _HTML_TAG_RE.sub('', cell_text)  # Remove HTML tags
             cell_text = cell_text.strip()
             
             # Set cell text
@@ -607,8 +669,15 @@ def create_formatted_table(doc: Document, md_table_text: str) -> Optional[Any]:
     
     return new_table
 
-def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path: Path) -> None:
-    """Open Pandoc DOCX, replace tables with python-docx formatted tables (improved matching)"""
+def _save_docx(doc: Document, out) -> None:
+    """Save a Document to a filesystem path or a file-like (e.g. io.BytesIO)."""
+    doc.save(out if hasattr(out, "write") else str(out))
+
+def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path) -> None:
+    """Open Pandoc DOCX, replace tables with python-docx formatted tables (improved matching)
+
+    out_path may be a Path or a writable file-like object.
+    """
     # Open Pandoc-generated DOCX
     try:
         doc = Document(str(pandoc_docx_path))
@@ -621,7 +690,7 @@ def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path: Path)
     
     if not md_tables:
         print("[INFO] No tables found in markdown - saving Pandoc DOCX as-is")
-        doc.save(str(out_path))
+        _save_docx(doc, out_path)
         return
     
     # Get all tables from the document
@@ -629,7 +698,7 @@ def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path: Path)
     
     if not docx_tables:
         print("[INFO] No tables found in Pandoc DOCX - saving as-is")
-        doc.save(str(out_path))
+        _save_docx(doc, out_path)
         return
     
     print(f"[INFO] Found {len(md_tables)} markdown tables and {len(docx_tables)} DOCX tables")
@@ -665,7 +734,7 @@ def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path: Path)
     
     if not matched_pairs:
         print("[WARN] Could not match any tables - saving Pandoc DOCX as-is")
-        doc.save(str(out_path))
+        _save_docx(doc, out_path)
         return
     
     print(f"[INFO] Matched {len(matched_pairs)} tables for replacement")
@@ -703,20 +772,25 @@ def replace_tables_in_docx(pandoc_docx_path: Path, md_text: str, out_path: Path)
     
     # Save the modified document
     try:
-        doc.save(str(out_path))
+        _save_docx(doc, out_path)
         print(f"[OK] Saved hybrid DOCX with {len(matched_pairs)} tables replaced")
     except Exception as e:
         print(f"[ERR] Failed to save DOCX: {e}")
         raise
 
 
-def build_hybrid_docx(md_text: str, pages_text: List[str], 
+def build_hybrid_docx(md_text: str, pages_text: List[str],
                      images_by_page: Dict[int, List[Path]],
                      crops_by_page: Dict[int, List[Path]],
-                     out_path: Path,
+                     out_path,
                      insert_page_breaks: bool,
                      image_max_width_in: float) -> None:
-    """Build DOCX using Pandoc (for math) + python-docx (for better tables) - improved version"""
+    """Build DOCX using Pandoc (for math) + python-docx (for better tables) - improved version
+
+    out_path may be a Path or a writable file-like (e.g. io.BytesIO) to keep
+    the result in memory and skip the filesystem round-trip.
+    """
+    out_is_buffer = hasattr(out_path, "write")
     with tempfile.TemporaryDirectory() as td:
         temp_pandoc_docx = Path(td) / "pandoc_temp.docx"
         
@@ -742,19 +816,27 @@ def build_hybrid_docx(md_text: str, pages_text: List[str],
             replace_tables_in_docx(temp_pandoc_docx, md_text, out_path)
             
             # Verify output
-            if out_path.exists():
+            if out_is_buffer:
+                print(f"[OK] Hybrid DOCX written to in-memory buffer")
+                print(f"      ✓ Math: Pandoc (best quality)")
+                print(f"      ✓ Tables: python-docx (better formatting)")
+            elif out_path.exists():
                 size = out_path.stat().st_size
                 print(f"[OK] Hybrid DOCX written: {out_path.name} ({size} bytes)")
                 print(f"      ✓ Math: Pandoc (best quality)")
                 print(f"      ✓ Tables: python-docx (better formatting)")
             else:
                 raise RuntimeError("Output DOCX file was not created")
-            
+
         except Exception as e:
             # Fallback: if Pandoc fails, use pure python-docx
             print(f"[WARN] Hybrid approach failed ({type(e).__name__}: {e})")
             print(f"[INFO] Falling back to pure python-docx (tables will be good, math may be plain text)...")
             try:
+                if out_is_buffer:
+                    # Discard whatever the failed attempt wrote to the buffer
+                    out_path.seek(0)
+                    out_path.truncate(0)
                 build_docx_with_python_docx_to_path(
                     pages_text,
                     images_by_page=images_by_page,
@@ -763,7 +845,7 @@ def build_hybrid_docx(md_text: str, pages_text: List[str],
                     insert_page_breaks=insert_page_breaks,
                     image_max_width_in=image_max_width_in,
                 )
-                print(f"[OK] Fallback DOCX written: {out_path.name}")
+                print(f"[OK] Fallback DOCX written: {'<buffer>' if out_is_buffer else out_path.name}")
             except Exception as fallback_error:
                 print(f"[ERR] Fallback also failed: {fallback_error}")
                 raise
@@ -811,8 +893,8 @@ def build_docx_with_python_docx_to_path(pages_text: List[str],
         
         if insert_page_breaks and i < len(pages_text):
             doc.add_page_break()
-    
-    doc.save(out_path)
+
+    _save_docx(doc, out_path)
 
 # ==== Regions JSON -> saved crops ============================================
 def crops_from_regions(pdf_path: Path, regions_json_path: Path, dpi: int, assets_dir: Path) -> Dict[int, List[Path]]:
@@ -910,6 +992,7 @@ def main():
 
     pdf_bytes = pdf_path.read_bytes()
     print(f"[INFO] file={pdf_path.name} bytes={len(pdf_bytes)}")
+    pdf_bytes = maybe_compress_pdf(pdf_bytes)
 
     payload = {
         "model": MISTRAL_MODEL,